@@ -4,6 +4,7 @@ import argparse
 import concurrent.futures
 import logging
 import os
+import re
 import sqlite3
 import sys
 import time
@@ -11,6 +12,8 @@ from hashlib import md5
 from pathlib import Path
 from uuid import UUID
 
+IMAGE_PATH_RE = re.compile(r'([^|*]+)\*[^|]*') # image entries are path*attributes, separated by |
+
 def md5utf16(string):
     data = string.encode('utf-16le')
     return md5(data).digest()
@@ -34,7 +37,7 @@ def migrate_image_wrap(args):
     migrate_image(*args)
 
 def migrate_image(RealMetadataPath, src, dst):
-    if any((not x.startswith(RealMetadataPath) for x in [dst, src])):
+    if not (dst.startswith(RealMetadataPath) and src.startswith(RealMetadataPath)):
         logging.warning(f'not in realmetadatapath: {src} -> {dst}')
         return 0
     dst_dir, _ = os.path.split(dst)
@@ -60,30 +63,59 @@ def migrate_image(RealMetadataPath, src, dst):
         return 1
     return 0
 
+def delete_metadata_path(real_path):
+    try:
+        os.unlink(real_path)
+    except FileNotFoundError:
+        logging.warning(f'Missing leftover metadata path {real_path}')
+        return 0
+    except OSError as e:
+        logging.warning(f'Failed to remove path: {e}')
+        return 0
+    try:
+        os.rmdir(real_path.parent)
+    except OSError as e:
+        logging.warning(f'Failed to remove path: {e}')
+    return 1
+
 def executemany(c, query, args):
     start = time.time()
-    c.executemany(query, args)
+    c.executemany(query, args) # args may be any iterable, e.g. a generator
     end = time.time()
-    if type(args) != 'generator':
-        logging.info(f'Running {len(args)} queries "{query}", took {end - start:.2f}s')
+    logging.info(f'Running "{query}" on {c.rowcount} rows, took {end - start:.2f}s')
 
 def replace_file(path, patterns, replacement):
     with open(path, 'rt') as fin:
         text = fin.read()
+    new_text = text
     for pat in patterns:
-        logging.debug(f'Replacing {pat} with {replacement} in {path}')
-        text = text.replace(pat, replacement)
-    with open(path, 'wt') as fout:
-        fout.write(text)
+        if pat in new_text:
+            logging.debug(f'Replacing {pat} with {replacement} in {path}')
+            new_text = new_text.replace(pat, replacement)
+    if new_text != text: # leave untouched files alone
+        with open(path, 'wt') as fout:
+            fout.write(new_text)
 
 def fix_collection_files(RealCollectionRoot, OldPaths, NewPath):
-    for root, dirs, files in os.walk(RealCollectionRoot):
-        for f in files:
-            replace_file(f'{root}/{f}', OldPaths, NewPath)
+    for entry in os.scandir(RealCollectionRoot):
+        if entry.is_dir(follow_symlinks=False):
+            fix_collection_files(entry.path, OldPaths, NewPath)
+        elif entry.is_file():
+            replace_file(entry.path, OldPaths, NewPath)
 
 def db_prepare(c):
-    c.execute('PRAGMA synchronous = OFF')
-    c.execute('PRAGMA journal_mode = MEMORY')
+    c.execute('PRAGMA journal_mode = WAL')
+    c.execute('PRAGMA synchronous = NORMAL')
+    c.execute('PRAGMA wal_autocheckpoint = 0') # checkpoint once before closing
+    c.execute('PRAGMA cache_size = -262144') # 256 MiB
+    c.execute('PRAGMA temp_store = MEMORY')
+    c.execute('PRAGMA mmap_size = 268435456')
+    c.execute('BEGIN IMMEDIATE') # everything from here on runs in one transaction, the pragmas above cannot be changed inside it
+    c.execute('CREATE INDEX IF NOT EXISTS idx_TypeTypedBaseItems on TypedBaseItems(type)')
+    # guid is the primary key in jellyfins schema, so only index it if the parent walk would scan the table otherwise
+    plan = c.execute('EXPLAIN QUERY PLAN select ParentId from TypedBaseItems where guid=?', (b'',)).fetchall()
+    if any(detail.startswith('SCAN') for *_, detail in plan):
+        c.execute('CREATE INDEX IF NOT EXISTS idx_GuidTypedBaseItems on TypedBaseItems(guid)')
     # c.execute('CREATE INDEX IF NOT EXISTS idx_SeasonIdTypedBaseItems on TypedBaseItems(SeasonId)')
     # c.execute('CREATE INDEX IF NOT EXISTS idx_SeriesIdTypedBaseItems on TypedBaseItems(SeriesId)')
     # c.execute('CREATE INDEX IF NOT EXISTS idx_TopParentIdTypedBaseItems on TypedBaseItems(TopParentId)')
@@ -93,7 +125,8 @@ def db_prepare(c):
     # c.execute('CREATE INDEX IF NOT EXISTS idx_ItemIdAncestorIds on AncestorIds(ItemId)')
 
 def db_finalize(c):
-    pass
+    c.execute('DROP INDEX IF EXISTS idx_TypeTypedBaseItems')
+    c.execute('DROP INDEX IF EXISTS idx_GuidTypedBaseItems')
     # c.execute('DROP INDEX IF EXISTS idx_SeasonIdTypedBaseItems')
     # c.execute('DROP INDEX IF EXISTS idx_SeriesIdTypedBaseItems')
     # c.execute('DROP INDEX IF EXISTS idx_TopParentIdTypedBaseItems')
@@ -135,98 +168,81 @@ def prune_metadata(args):
     logging.info(f'Using jellyfin internal data path {args.programdata}')
     logging.info(f'Using jellyfin internal media path {args.mediadata}')
 
-    conn = sqlite3.connect(DBPath)
+    conn = sqlite3.connect(DBPath, isolation_level=None) # manage transactions explicitly
     c = conn.cursor()
     db_prepare(c)
 
-    unresolved_parents = list()
-    roots = list()
-    referenced_paths = list()
+    referenced_paths = set()
     changed_types = dict() # type -> count
-    delete_parent_guids = list() # guid bytes_le to delete
+    delete_parent_guids = set() # guid bytes_le to delete
 
-    # get all parents of this media type
-    for prune_type in prune_types:
-        logging.info(f'Getting all metadata entries of type {prune_type}...')
-        for parent_guid_bytes, path, images in c.execute('select ParentId,path,Images from TypedBaseItems where type=?', (prune_type,)):
-            if not any((path.startswith(x) for x in ['%MetadataPath%', args.mediadata, args.programdata])):
-                logging.warning(f'unknown path prefix in {path}')
+    # get all entries of this media type and walk up their parents until we reach an aggregate folder, i.e. the root of the directory tree
+    logging.info(f'Getting all metadata entries of types {", ".join(prune_types)} and their parents...')
+    type_placeholders = ','.join('?' * len(prune_types))
+    known_prefixes = ('%MetadataPath%', args.mediadata, args.programdata)
+    c_read = conn.cursor()
+    c_read.arraysize = 2000
+    c_read.execute(
+        'WITH RECURSIVE ancestors(guid,parentid,type,path,images) AS ('+
+            f'SELECT guid,ParentId,type,path,Images FROM TypedBaseItems WHERE type IN ({type_placeholders}) '+
+            'UNION '+
+            'SELECT t.guid,t.ParentId,t.type,t.path,t.Images FROM TypedBaseItems t JOIN ancestors a ON t.guid=a.parentid '+
+            'WHERE t.type <> "MediaBrowser.Controller.Entities.AggregateFolder"'+
+        ') SELECT * FROM ancestors', prune_types)
+    while batch := c_read.fetchmany():
+        for guid_bytes, parent_guid_bytes, mediatype, path, images in batch:
             if not path.startswith(args.mediadata): # do not remove actual media
-                referenced_paths += [path]
+                referenced_paths.add(path)
             if images is not None:
-                img_paths = [img.split('*',1)[0] for img in images.split('|')]
-                referenced_paths += img_paths
-            if prune_type not in changed_types:
-                changed_types[prune_type] = 1
+                referenced_paths.update(IMAGE_PATH_RE.findall(images))
+            if not path.startswith(known_prefixes):
+                logging.warning(f'unknown path prefix in {path}')
+            if mediatype not in changed_types:
+                changed_types[mediatype] = 1
             else:
-                changed_types[prune_type] += 1
-            if not parent_guid_bytes:
-                continue
-            unresolved_parents += [UUID(bytes_le=parent_guid_bytes)]
-
-    logging.info(f'found {len(unresolved_parents)} parents')
+                changed_types[mediatype] += 1
+            if mediatype not in prune_types:
+                delete_parent_guids.add(guid_bytes)
 
-    iteration = 0
-    while len(unresolved_parents):
-        iteration += 1
-        logging.info(f'Resolving parents recursively, iteration {iteration}, {len(unresolved_parents)} parents remaining')
-        new_unresolved_parents = []
-        for guid in unresolved_parents:
-            for guid_bytes, parent_guid_bytes, mediatype, path, images in c.execute('select guid,ParentId,type,path,Images from TypedBaseItems where guid=?', (guid.bytes_le,)):
-                # stop if we reach an aggregate folder, i.e. the root of the directory tree
-                if mediatype == 'MediaBrowser.Controller.Entities.AggregateFolder':
-                    continue
-                if not path.startswith(args.mediadata): # do not remove actual media
-                    referenced_paths += [path]
-                if images is not None:
-                    img_paths = [img.split('*',1)[0] for img in images.split('|')]
-                    referenced_paths += img_paths
-                if not any((path.startswith(x) for x in ['%MetadataPath%', args.mediadata, args.programdata])):
-                    logging.warning(f'unknown path prefix in {path}')
-                if mediatype not in changed_types:
-                    changed_types[mediatype] = 1
-                else:
-                    changed_types[mediatype] += 1
-                if not guid.bytes_le in delete_parent_guids:
-                    delete_parent_guids += [guid.bytes_le]
-                new_unresolved_parents += [UUID(bytes_le=parent_guid_bytes)]
-        unresolved_parents = list(set(new_unresolved_parents))
+    logging.info(f'found {len(delete_parent_guids)} parents')
 
-    executemany(c, 'delete from TypedBaseItems where type=?', list(((x,) for x in prune_types)))
-    executemany(c, 'delete from TypedBaseItems where guid=?', list(((x,) for x in delete_parent_guids)))
+    c.execute(f'delete from TypedBaseItems where type in ({type_placeholders})', prune_types)
+    logging.info(f'deleted {c.rowcount} entries of types {", ".join(prune_types)}')
+    c.execute('CREATE TEMP TABLE tmp_delete(guid BLOB PRIMARY KEY) WITHOUT ROWID')
+    executemany(c, 'insert into tmp_delete values(?)', ((x,) for x in delete_parent_guids))
+    c.execute('delete from TypedBaseItems where guid in (select guid from tmp_delete)')
+    logging.info(f'deleted {c.rowcount} parent entries')
 
     if args.delete_metadata_folders:
-        delete_path_count = 0
+        # jellyfin path prefix -> physical directory it refers to
+        path_prefixes = (
+            ('%MetadataPath%/', RealMetadataPath),
+            ('/config/metadata/', RealMetadataPath),
+        )
+        real_paths = list()
         for path in referenced_paths:
-            if path.startswith('%MetadataPath%/'):
-                real_path = RealMetadataPath / path.removeprefix('%MetadataPath%/')
-            elif path.startswith('/config/metadata/'):
-                real_path = RealMetadataPath / path.removeprefix('/config/metadata/')
-            elif path.startswith('root/metadata/'):
+            if path.startswith('root/metadata/'):
                 # seems like root/* paths are purely virtual, so skip them
                 continue
+            for prefix, real_root in path_prefixes:
+                if path.startswith(prefix):
+                    real_paths += [real_root / path[len(prefix):]]
+                    break
             # else:
             #     # real_path = RealDataPath
             #     print(f'real path {path}')
-            try:
-                if real_path.exists():
-                    # logging.info(f'Leftover metadata path {real_path}')
-                    delete_path_count += 1
-                    real_path.unlink()
-                    real_path.parent.rmdir()
-                else:
-                    logging.warning(f'Missing leftover metadata path {real_path}')
-            except OSError as e:
-                logging.warning(f'Failed to remove path: {e}')
-        logging.info(f'Found {delete_path_count} paths to delete')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            delete_path_count = sum(executor.map(delete_metadata_path, real_paths))
+        logging.info(f'Deleted {delete_path_count} leftover metadata paths')
 
-    # db_finalize(c)
+    db_finalize(c)
     conn.commit()
 
     if not args.vacuum:
         logging.info('vacuuming database')
         c.execute('vacuum')
 
+    c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
     conn.close()
 
     for typename, count in changed_types.items():
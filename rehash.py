@@ -7,13 +7,21 @@ import os
 import sqlite3
 import sys
 import time
+from enum import Enum
 from hashlib import md5
 from pathlib import Path
 from uuid import UUID
 
-def md5utf16(string):
-    data = string.encode('utf-16le')
-    return md5(data).digest()
+HASH_POOL_MIN_ROWS = 50000 # hash in a process pool only for libraries with at least this many items
+
+md5_prefix_cache = dict() # prefix -> md5 object already fed with the encoded prefix
+
+def md5utf16(string, prefix=''):
+    if prefix not in md5_prefix_cache:
+        md5_prefix_cache[prefix] = md5(prefix.encode('utf-16le'))
+    m = md5_prefix_cache[prefix].copy()
+    m.update(string.encode('utf-16le'))
+    return m.digest()
 
 # loosely adapted from https://github.com/jellyfin/jellyfin/blob/master/Emby.Server.Implementations/Library/LibraryManager.cs#L504 (GetNewItemIdInternal)
 def hash(ProgramDataPath, key, typename, CaseSensitive=True):
@@ -21,8 +29,10 @@ def hash(ProgramDataPath, key, typename, CaseSensitive=True):
         key = key[len(ProgramDataPath):].lstrip('/\\').replace('/','\\')
     if not CaseSensitive:
         key = key.lower()
-    key = typename + key
-    return UUID(bytes_le=md5utf16(key))
+    return md5utf16(key, prefix=typename) # guid as bytes_le, cheap to pass back from pool workers
+
+def hash_batch(args_list):
+    return [hash(*args) for args in args_list]
 
 def migrate_paths(c, old_path, new_path):
     c.execute('update TypedBaseItems set Path=Replace(Path,?,?) where Path like ?', (old_path, new_path, old_path+'%'))
@@ -31,20 +41,31 @@ def migrate_paths(c, old_path, new_path):
     c.execute('update mediastreams set Path=Replace(Path,?,?) where Path like ?', (old_path, new_path, old_path+'%'))
 
 def migrate_image_wrap(args):
-    migrate_image(*args)
+    return migrate_image(*args)
+
+class ImageStatus(Enum):
+    MOVED = 1 # image moved to its new location
+    ALREADY_THERE = 2 # image not found at its old but at its new location
+    MISSING = 3 # image neither found at its old nor at its new location
+    FAILED = 4 # image could not be moved and remains at its old location
 
 def migrate_image(RealMetadataPath, src, dst):
-    if any((not x.startswith(RealMetadataPath) for x in [dst, src])):
+    if not (dst.startswith(RealMetadataPath) and src.startswith(RealMetadataPath)):
         logging.warning(f'not in realmetadatapath: {src} -> {dst}')
-        return 0
-    dst_dir, _ = os.path.split(dst)
+        return ImageStatus.FAILED
     try:
-        logging.debug(f'mkdir {dst_dir}')
-        os.makedirs(dst_dir, exist_ok=True)
-
         logging.debug(f'mv {src} {dst}')
         # stat = os.stat(src)
-        os.rename(src, dst)
+        try:
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # either the source is gone or the destination directory does not exist yet
+            if not os.path.exists(src):
+                return ImageStatus.ALREADY_THERE if os.path.exists(dst) else ImageStatus.MISSING
+            dst_dir, _ = os.path.split(dst)
+            logging.debug(f'mkdir {dst_dir}')
+            os.makedirs(dst_dir, exist_ok=True)
+            os.rename(src, dst)
         # restore mtime to stop jellyfin from rewriting the db entry of this image
         # os.utime(dst, (stat.st_atime, stat.st_mtime))
 
@@ -56,48 +77,65 @@ def migrate_image(RealMetadataPath, src, dst):
             pass
     except OSError as e:
         logging.error(f'Failed to move {src} to {dst}: {e}')
-    else:
-        return 1
-    return 0
+        return ImageStatus.FAILED
+    return ImageStatus.MOVED
 
 def executemany(c, query, args):
     start = time.time()
-    c.executemany(query, args)
+    c.executemany(query, args) # args may be any iterable, e.g. a generator
     end = time.time()
-    logging.info(f'Running {len(args)} queries "{query}", took {end - start:.2f}s')
+    logging.info(f'Running "{query}" on {c.rowcount} rows, took {end - start:.2f}s')
+
+def execute(c, query, args=()):
+    start = time.time()
+    c.execute(query, args)
+    end = time.time()
+    logging.info(f'Running "{query}" on {c.rowcount} rows, took {end - start:.2f}s')
+
+# replace guids in columns by their new value from the guid_map temp table, columns maps column name to one of raw, hex or str
+# each coalesce subquery must resolve to a guid_map index search, so guid_map columns have to match the affinity of the remapped columns
+def remap_columns(c, table, columns):
+    assignments = ', '.join(f'{column}=coalesce((select new_{form} from guid_map where old_{form}={table}.{column}),{column})' for column, form in columns.items())
+    conditions = ' or '.join(f'{column} in (select old_{form} from guid_map)' for column, form in columns.items())
+    execute(c, f'update {table} set {assignments} where {conditions}')
+
+def remap_column(c, table, column, form):
+    remap_columns(c, table, {column: form})
 
 def replace_file(path, patterns, replacement):
     with open(path, 'rt') as fin:
         text = fin.read()
+    new_text = text
     for pat in patterns:
-        logging.debug(f'Replacing {pat} with {replacement} in {path}')
-        text = text.replace(pat, replacement)
-    with open(path, 'wt') as fout:
-        fout.write(text)
+        if pat in new_text:
+            logging.debug(f'Replacing {pat} with {replacement} in {path}')
+            new_text = new_text.replace(pat, replacement)
+    if new_text != text: # leave untouched files alone
+        with open(path, 'wt') as fout:
+            fout.write(new_text)
 
 def fix_collection_files(RealCollectionRoot, OldPaths, NewPath):
-    for root, dirs, files in os.walk(RealCollectionRoot):
-        for f in files:
-            replace_file(f'{root}/{f}', OldPaths, NewPath)
+    for entry in os.scandir(RealCollectionRoot):
+        if entry.is_dir(follow_symlinks=False):
+            fix_collection_files(entry.path, OldPaths, NewPath)
+        elif entry.is_file():
+            replace_file(entry.path, OldPaths, NewPath)
 
 def db_prepare(c):
-    c.execute('PRAGMA synchronous = OFF')
-    c.execute('PRAGMA journal_mode = MEMORY')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_SeasonIdTypedBaseItems on TypedBaseItems(SeasonId)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_SeriesIdTypedBaseItems on TypedBaseItems(SeriesId)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_TopParentIdTypedBaseItems on TypedBaseItems(TopParentId)')
+    c.execute('PRAGMA journal_mode = WAL')
+    c.execute('PRAGMA synchronous = NORMAL')
+    c.execute('PRAGMA wal_autocheckpoint = 0') # checkpoint once before closing
+    c.execute('PRAGMA cache_size = -262144') # 256 MiB
+    c.execute('PRAGMA temp_store = MEMORY')
+    c.execute('PRAGMA mmap_size = 268435456')
+    c.execute('BEGIN IMMEDIATE') # everything from here on runs in one transaction, the pragmas above cannot be changed inside it
     c.execute('CREATE INDEX IF NOT EXISTS idx_PresentationUniqueKeyTypedBaseItems on TypedBaseItems(PresentationUniqueKey)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_SeriesPresentationUniqueKeyTypedBaseItems on TypedBaseItems(SeriesPresentationUniqueKey)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_UserDataKeyTypedBaseItems on TypedBaseItems(UserDataKey)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_ItemIdAncestorIds on AncestorIds(ItemId)')
 
 def db_finalize(c):
-    c.execute('DROP INDEX IF EXISTS idx_SeasonIdTypedBaseItems')
-    c.execute('DROP INDEX IF EXISTS idx_SeriesIdTypedBaseItems')
-    c.execute('DROP INDEX IF EXISTS idx_TopParentIdTypedBaseItems')
     c.execute('DROP INDEX IF EXISTS idx_PresentationUniqueKeyTypedBaseItems')
     c.execute('DROP INDEX IF EXISTS idx_SeriesPresentationUniqueKeyTypedBaseItems')
-    c.execute('DROP INDEX IF EXISTS idx_UserDataKeyTypedBaseItems')
     c.execute('DROP INDEX IF EXISTS idx_ItemIdAncestorIds')
 
 def rehash(args):
@@ -123,7 +161,7 @@ def rehash(args):
     logging.info(f'Using jellyfin internal data path {args.programdata}')
     logging.info(f'Using jellyfin media path {args.media_path}')
 
-    conn = sqlite3.connect(DBPath)
+    conn = sqlite3.connect(DBPath, isolation_level=None) # manage transactions explicitly
     c = conn.cursor()
     db_prepare(c)
 
@@ -143,100 +181,126 @@ def rehash(args):
         kodi_sql_file.write('BEGIN TRANSACTION;\n')
 
     logging.info('Calculating new hashes and checking images')
-    changed_types = list()
+    # read in batches on a dedicated cursor and hash each batch in the pool while the next one is fetched
+    c_read = conn.cursor()
+    c_read.arraysize = 2000
+    c_read.execute('select guid,type,name,path,Images from TypedBaseItems where path like ?', (args.media_path+'%',))
+    # small libraries or single cpus are hashed inline, as the pool overhead outweighs the hashing itself
+    rows = list()
+    new_guids = list()
+    hash_futures = list()
+    executor = None
+    while batch := c_read.fetchmany():
+        rows += batch
+        hash_args = [(args.programdata, path, typename, args.case_sensitive) for _, typename, _, path, _ in batch]
+        if executor is None and len(rows) >= HASH_POOL_MIN_ROWS and (os.cpu_count() or 1) > 1:
+            executor = concurrent.futures.ProcessPoolExecutor()
+        if executor is None:
+            new_guids += hash_batch(hash_args)
+        else:
+            hash_futures += [executor.submit(hash_batch, hash_args)]
+    if executor is not None:
+        with executor:
+            new_guids += [new_guid for future in hash_futures for new_guid in future.result()]
+
+    changed_types = set()
     guid_updates = list()
     image_updates = list()
-    move_image_dirs = list() # from, to
-    for guid_bytes, typename, name, path, images in c.execute('select guid,type,name,path,Images from TypedBaseItems where path like ?', (args.media_path+'%',)):
-        if typename not in changed_types:
-            changed_types += [typename]
+    move_image_dirs = list() # from, to, old image entry, new image entry
+    pending_image_updates = list() # name, guid bytes_le, image entries or indices into move_image_dirs
+    ProgramDataMetadataPath = args.programdata+'/metadata'
+    RealMetadataPathStr = str(RealMetadataPath)
+    for (guid_bytes, typename, name, path, images), new_guid_bytes in zip(rows, new_guids):
+        changed_types.add(typename)
+
+        if new_guid_bytes == guid_bytes:
+            logging.debug(f'hash unchanged for {name} {path}')
+            continue # images of unchanged items stay where they are
 
         guid = UUID(bytes_le=guid_bytes)
-        logging.debug(f'processing {name} ({guid}) {path}')
-
-        new_guid = hash(args.programdata, path, typename, CaseSensitive=args.case_sensitive)
-        if new_guid != guid:
-            logging.debug(f'new hash {new_guid} for {path}')
-            guid_updates += [{
-                'new_raw': new_guid.bytes_le, # b'|\x17\x10i)\xdd\xcepX\xd9wm\xd0\xf0\xaa\x11'
-                'new_hex': new_guid.hex, # '6910177cdd2970ce58d9776dd0f0aa11'
-                'new_str': str(new_guid), # '6910177c-dd29-70ce-58d9-776dd0f0aa11'
-                'old_raw': guid.bytes_le,
-                'old_hex': guid.hex,
-                'old_str': str(guid),
-                'type': typename,
-            }]
-            if args.kodi_sql:
-                kodi_sql_file.write(f'UPDATE files SET strFilename=replace(strFilename, "{guid.hex}", "{new_guid.hex}") WHERE strFilename like "%id={guid.hex}%";\n')
-        else:
-            logging.debug(f'hash unchanged for {path}')
+        new_guid = UUID(bytes_le=new_guid_bytes)
+        logging.debug(f'new hash {new_guid} for {name} ({guid}) {path}')
+        guid_updates += [{
+            'new_raw': new_guid.bytes_le, # b'|\x17\x10i)\xdd\xcepX\xd9wm\xd0\xf0\xaa\x11'
+            'new_hex': new_guid.hex, # '6910177cdd2970ce58d9776dd0f0aa11'
+            'new_str': str(new_guid), # '6910177c-dd29-70ce-58d9-776dd0f0aa11'
+            'old_raw': guid.bytes_le,
+            'old_hex': guid.hex,
+            'old_str': str(guid),
+            'type': typename,
+        }]
+        if args.kodi_sql:
+            kodi_sql_file.write(f'UPDATE files SET strFilename=replace(strFilename, "{guid.hex}", "{new_guid.hex}") WHERE strFilename like "%id={guid.hex}%";\n')
 
         if args.move_images and RealMetadataPath is not None:
             if images is None:
                 logging.debug(f'no images for {name}')
             else:
                 imgs_split = images.split('|')
-                imgs_result = list()
-                needs_update = False
+                imgs_pending = list()
+                needs_move = False
 
                 for img in imgs_split:
                     old_img_path, attrs = img.split('*',1)
                     if old_img_path.startswith('%MetadataPath%'):
-                        old_physical_path = old_img_path.replace('%MetadataPath%', str(RealMetadataPath))
-                    elif old_img_path.startswith(args.programdata+'/metadata'):
-                        old_physical_path = old_img_path.replace(args.programdata+'/metadata', str(RealMetadataPath))
+                        old_physical_path = old_img_path.replace('%MetadataPath%', RealMetadataPathStr)
+                    elif old_img_path.startswith(ProgramDataMetadataPath):
+                        old_physical_path = old_img_path.replace(ProgramDataMetadataPath, RealMetadataPathStr)
                     else:
                         logging.debug('Skipping non-metadata image: {old_img_path}')
-                        imgs_result += [img]
+                        imgs_pending += [img]
                         continue # do not touch images in media folders or web links
                     logging.debug(f'checking image {img}')
                     old_guid_filesystem = guid.hex
                     new_guid_filesystem = new_guid.hex
-                    if guid != new_guid and old_guid_filesystem not in old_img_path:
+                    if old_guid_filesystem not in old_img_path:
                         logging.info(f'Keeping image not matching guid of {name}: {img}')
-                        imgs_result += [img]
+                        imgs_pending += [img]
                         continue
                     old_subpath = f'/{old_guid_filesystem[:2]}/{old_guid_filesystem}'
                     new_subpath = f'/{new_guid_filesystem[:2]}/{new_guid_filesystem}'
                     new_img_path = old_img_path.replace(old_subpath, new_subpath)
                     new_physical_path = old_physical_path.replace(old_subpath, new_subpath)
-                    if not os.path.exists(old_physical_path):
-                        if not os.path.exists(new_physical_path):
-                            logging.info(f'Removing nonexistent image of {name}: {old_img_path}')
-                            continue
-                        else:
-                            needs_update = True # already moved, so fix the location
-                    elif old_physical_path != new_physical_path:
-                        move_image_dirs += [(old_physical_path, new_physical_path)]
-                        needs_update = True
+                    if old_physical_path != new_physical_path:
+                        # whether the image is actually moved is only known after migrate_image ran
+                        imgs_pending += [len(move_image_dirs)]
+                        move_image_dirs += [(old_physical_path, new_physical_path, img, f'{new_img_path}*{attrs}')]
+                        needs_move = True
                         logging.debug(f'to -> {new_img_path}')
                     else:
-                        pass # old and new paths match
-                    imgs_result += [f'{new_img_path}*{attrs}']
+                        imgs_pending += [img] # old and new paths match
 
-                imgs_update = '|'.join(imgs_result) if len(imgs_result) > 0 else None
-                if needs_update:
-                    image_updates += [(imgs_update, new_guid.bytes_le)]
+                if needs_move:
+                    pending_image_updates += [(name, new_guid.bytes_le, imgs_pending)]
 
     if args.kodi_sql:
         kodi_sql_file.write('END TRANSACTION;\n')
         logging.info(f'Kodi SQL file written to {args.kodi_sql}')
     logging.info(f'updating {len(guid_updates)} hashes')
 
-    # we have to do multiple iterations on TypedBaseItems as some keys are parent id mappings where both may need to be updated differently
-    executemany(c, 'update TypedBaseItems set guid=:new_raw where guid=:old_raw', guid_updates)
-    executemany(c, 'update TypedBaseItems set parentid=:new_raw where parentid=:old_raw', guid_updates)
-    executemany(c, 'update TypedBaseItems set SeasonId=:new_raw where SeasonId=:old_raw', guid_updates)
-    executemany(c, 'update TypedBaseItems set SeriesId=:new_raw where SeriesId=:old_raw', guid_updates)
-    executemany(c, 'update TypedBaseItems set TopParentId=:new_hex where TopParentId=:old_hex', guid_updates)
-    executemany(c, 'update TypedBaseItems set UserDataKey=:new_str where UserDataKey=:old_str', guid_updates)
+    # load all guid changes into a mapping table, so each column is remapped by a single update statement
+    # raw columns must be declared GUID like jellyfins id columns, otherwise the affinity mismatch prevents primary key lookups
+    c.execute('CREATE TEMP TABLE guid_map(old_raw GUID PRIMARY KEY, new_raw GUID, old_hex TEXT, new_hex TEXT, old_str TEXT, new_str TEXT) WITHOUT ROWID')
+    c.execute('CREATE INDEX idx_OldHexGuidMap on guid_map(old_hex)')
+    c.execute('CREATE INDEX idx_OldStrGuidMap on guid_map(old_str)')
+    executemany(c, 'insert into guid_map values(:old_raw,:new_raw,:old_hex,:new_hex,:old_str,:new_str)', guid_updates)
+
+    # all id columns of a row are remapped in one pass against the original guids, so parent id mappings where both may need to be updated differently stay consistent
+    remap_columns(c, 'TypedBaseItems', {
+        'guid': 'raw',
+        'parentid': 'raw',
+        'SeasonId': 'raw',
+        'SeriesId': 'raw',
+        'TopParentId': 'hex',
+        'UserDataKey': 'str',
+    })
 
     if args.old_paths:
         # data is special: For collection folders, it contains both its GUID as string and points to their physical path.
         executemany(c, 'update TypedBaseItems set data=Replace(data,:old_path,:new_path) where type="MediaBrowser.Controller.Entities.CollectionFolder"',
-            [{'old_path': old_path, 'new_path': args.media_path} for old_path in args.old_paths])
+            ({'old_path': old_path, 'new_path': args.media_path} for old_path in args.old_paths))
         executemany(c, 'update TypedBaseItems set data=Replace(data,:old_str,:new_str) where type="MediaBrowser.Controller.Entities.CollectionFolder"',
-            [x for x in guid_updates if x['type'] == 'MediaBrowser.Controller.Entities.Folder'])
+            (x for x in guid_updates if x['type'] == 'MediaBrowser.Controller.Entities.Folder'))
 
     # PresentationUniqueKey is special. It may be:
     # - null
@@ -246,38 +310,54 @@ def rehash(args):
     # - 9e5ee0206d5d6e5d19f6748aad5bac0d (GUID in hex form) [episodes only]
     # SeriesPresentationUniqueKey is related: If not null, it matches PresentationUniqueKey of its SeriesId base element (why not just do a join there?)
     # Thus, we need to do text-based replacements for PresentationUniqueKey columns to catch cases using GUID instead of external ids.
-    executemany(c, 'update TypedBaseItems set PresentationUniqueKey=Replace(PresentationUniqueKey,:old_hex,:new_hex) '+
-                   'where PresentationUniqueKey is not null and length(PresentationUniqueKey) < 37 and PresentationUniqueKey like :like_old_hex',
-        [{**d, 'like_old_hex': f'{d["old_hex"]}%'} for d in guid_updates])
-    executemany(c, 'update TypedBaseItems set SeriesPresentationUniqueKey=:new_hex where length(SeriesPresentationUniqueKey) = 32 and SeriesPresentationUniqueKey=:old_hex', guid_updates)
-
-    executemany(c, 'update AncestorIds set AncestorId=:new_raw, AncestorIdText=:new_hex where AncestorId=:old_raw', guid_updates)
-    executemany(c, 'update AncestorIds set ItemId=:new_raw where ItemId=:old_raw', guid_updates)
-
-    executemany(c, 'update ItemValues set ItemId=:new_raw where ItemId=:old_raw', guid_updates)
-    executemany(c, 'update People set ItemId=:new_raw where ItemId=:old_raw', guid_updates)
-    executemany(c, 'update Chapters2 set ItemId=:new_raw where ItemId=:old_raw', guid_updates)
-    executemany(c, 'update mediastreams set ItemId=:new_raw where ItemId=:old_raw', guid_updates)
-    executemany(c, 'update mediaattachments set ItemId=:new_raw where ItemId=:old_raw', guid_updates)
-    executemany(c, 'update UserDatas set key=:new_str where key=:old_str', guid_updates)
+    executemany(c, 'update TypedBaseItems set PresentationUniqueKey=Replace(PresentationUniqueKey,?,?) '+
+                   'where PresentationUniqueKey is not null and length(PresentationUniqueKey) < 37 and PresentationUniqueKey like ?',
+        ((d['old_hex'], d['new_hex'], d['old_hex']+'%') for d in guid_updates))
+    remap_column(c, 'TypedBaseItems', 'SeriesPresentationUniqueKey', 'hex')
+
+    execute(c, 'update AncestorIds set AncestorId=(select new_raw from guid_map where old_raw=AncestorIds.AncestorId), '+
+                   'AncestorIdText=(select new_hex from guid_map where old_raw=AncestorIds.AncestorId) '+
+                   'where AncestorId in (select old_raw from guid_map)')
+    remap_column(c, 'AncestorIds', 'ItemId', 'raw')
+
+    remap_column(c, 'ItemValues', 'ItemId', 'raw')
+    remap_column(c, 'People', 'ItemId', 'raw')
+    remap_column(c, 'Chapters2', 'ItemId', 'raw')
+    remap_column(c, 'mediastreams', 'ItemId', 'raw')
+    remap_column(c, 'mediaattachments', 'ItemId', 'raw')
+    remap_column(c, 'UserDatas', 'key', 'str')
     # userdata table seems to be legacy
-    # executemany(c, 'update userdata set key=:new_str where key=:old_str', guid_updates)
+    # remap_column(c, 'userdata', 'key', 'str')
 
     if args.move_images:
-        logging.info('fixing image references')
-        executemany(c, 'update TypedBaseItems set Images=? where guid=?', image_updates)
-
         logging.info('moving images to new location')
-        moved_images = 0
-        for src, dst in move_image_dirs:
-            moved_images += migrate_image(str(RealMetadataPath), src, dst)
-        logging.info(f'moved {moved_images} image folders')
+        # renames are I/O bound and release the GIL, so threads keep the filesystem busy without process overhead
+        migrate_image_args = [(str(RealMetadataPath), src, dst) for src, dst, _, _ in move_image_dirs]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            image_status = list(executor.map(migrate_image_wrap, migrate_image_args))
+        logging.info(f'moved {image_status.count(ImageStatus.MOVED)} image folders')
+
+        for name, new_guid_bytes, imgs_pending in pending_image_updates:
+            imgs_result = list()
+            needs_update = False
+            for img in imgs_pending:
+                if isinstance(img, str):
+                    imgs_result += [img]
+                    continue
+                _, _, old_img, new_img = move_image_dirs[img]
+                if image_status[img] == ImageStatus.MISSING:
+                    logging.info(f'Removing nonexistent image of {name}: {old_img}')
+                elif image_status[img] == ImageStatus.FAILED:
+                    imgs_result += [old_img]
+                else:
+                    needs_update = True # moved now or already before, so fix the location
+                    imgs_result += [new_img]
+            imgs_update = '|'.join(imgs_result) if len(imgs_result) > 0 else None
+            if needs_update:
+                image_updates += [(imgs_update, new_guid_bytes)]
 
-        # experimental process pool image moving - is this really faster?
-        # migrate_image_args = [(str(RealMetadataPath), src, dst) for src, dst in move_image_dirs]
-        # with concurrent.futures.ProcessPoolExecutor() as executor:
-        #     moved_images = executor.map(migrate_image_wrap, migrate_image_args, chunksize=100)
-        # logging.info(f'moved {sum(moved_images)} image folders')
+        logging.info('fixing image references')
+        executemany(c, 'update TypedBaseItems set Images=? where guid=?', image_updates)
 
     db_finalize(c)
     conn.commit()
@@ -286,6 +366,7 @@ def rehash(args):
         logging.info('vacuuming database')
         c.execute('vacuum')
 
+    c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
     conn.close()
 
     logging.debug('Changed entries of these types:')